@@ -2,13 +2,23 @@
 Aggregation methods.
 """
 
+import collections
+import concurrent.futures
 import functools
+import math
+import threading
 
 import util
 
-class VotingRules:
+class CombinationRules:
     """
-    Summing composition of votes.
+    Composition of beliefs.
+
+    `combine` merges beliefs of different participants in the same statement, `multipath_combine`
+    merges beliefs propagated to the same statement from one description, and `negative` gives
+    the belief in statements disjoint with the described ones. Subclasses define `combine`.
+    `reduce` combines all the beliefs in a statement; rules may override it with a batched form,
+    which must agree with the pairwise composition of `combine` (in any order).
     """
 
     @staticmethod
@@ -19,63 +29,190 @@ class VotingRules:
     def negative(v):
         return -v
 
+    @classmethod
+    def reduce(cls, beliefs):
+        return functools.reduce(cls.combine, beliefs)
+
+# Registered combination rules (name -> class), see register_rules().
+combination_rules = {}
+
+def register_rules(name):
+    """Class decorator, registering combination rules under the given name."""
+    def decorator(cls):
+        combination_rules[name] = cls
+        return cls
+    return decorator
+
+def reduce_beliefs(combination_rules_cls, beliefs):
+    """Combines a non-empty list of beliefs, falling back to pairwise `combine` if the rules have no `reduce`."""
+    reduce = getattr(combination_rules_cls, 'reduce', None)
+    if reduce is None:
+        return functools.reduce(combination_rules_cls.combine, beliefs)
+    return reduce(beliefs)
+
+@register_rules('voting')
+class VotingRules(CombinationRules):
+    """
+    Summing composition of votes.
+    """
+
     @staticmethod
     def combine(v1, v2):
         return v1 + v2
 
-class SBRules:
+    @classmethod
+    def reduce(cls, beliefs):
+        return sum(beliefs)
+
+@register_rules('sb')
+class SBRules(CombinationRules):
     """Shortliffe-Buchanan (MYCIN) composition of beliefs.
 
     Each element of beliefs must be [-1, 1].
     
     See also: https://en.wikipedia.org/wiki/Mycin """
 
-    @staticmethod
-    def multipath_combine(v1, v2):
-        return max(v1, v2)
-
-    @staticmethod
-    def negative(v):
-        return -v
-
     @staticmethod
     def combine(v1, v2):
         if v1 <= 0 and v2 <= 0:
-            return v1 + v2 * (1 + v2)
+            return v1 + v2 * (1 + v1)
         elif v1 >= 0 and v2 >= 0:
             return v1 + v2 * (1 - v1)
         else:
             return (v1 + v2) / (1 - min(abs(v1), abs(v2)))
 
+    @classmethod
+    def reduce(cls, beliefs):
+        # Same-sign beliefs are combined in a closed (product) form, then the two groups are merged.
+        pos = [v for v in beliefs if v >= 0]
+        neg = [v for v in beliefs if v < 0]
+        p = 1 - math.prod(1 - v for v in pos)
+        n = math.prod(1 + v for v in neg) - 1
+        if not neg:
+            return p
+        if not pos:
+            return n
+        return cls.combine(p, n)
 
-def aggregate(descriptions, combination_rules_cls, support_threshold):
-    """Descriptions aggregation algorithm."""
-    
-    # Propagates participant's votes to all the generalizing statements.
+def _propagate_pairs(pairs):
+    """Propagates a unit belief in each of the packed (prop, val) pairs to all the generalizing pairs.
+
+    Returns a dict mapping each generalizing packed pair to the sign of the unit belief that
+    reaches it: `PropagationCache.POSITIVE`, `PropagationCache.NEGATIVE` or `PropagationCache.BOTH`.
+    """
+    signs = {}
+    for pair in pairs:
+        pos, neg = util.generalize_statement(*util.unpack_pair(pair))
+        for x in pos:
+            x = util.pack_pair(*x)
+            s = signs.get(x, PropagationCache.POSITIVE)
+            signs[x] = PropagationCache.POSITIVE if s == PropagationCache.POSITIVE else PropagationCache.BOTH
+        for x in neg:
+            x = util.pack_pair(*x)
+            s = signs.get(x, PropagationCache.NEGATIVE)
+            signs[x] = PropagationCache.NEGATIVE if s == PropagationCache.NEGATIVE else PropagationCache.BOTH
+    return signs
+
+class PropagationCache:
+    """Bounded memo of propagated descriptions.
+
+    Maps a canonical set of packed (prop, val) pairs (see `util.pack_pair()`) of one
+    participant's description of an item to
+    the multipath-combined propagation of a unit belief (see `_propagate_pairs`), so that
+    repeated descriptions skip propagation entirely. Least recently used entries are
+    evicted when there are more than `maxsize` of them. Entries invalidated by ontology
+    edits (see `util.HierarchyIndex`) are recomputed on access. The cache can be shared
+    between threads.
+
+    Relies on `multipath_combine` of the combination rules being commutative and
+    idempotent (as `max` is), so that a propagated value depends only on the belief and
+    on the signs of the paths reaching the statement.
+    """
+
+    POSITIVE = 1
+    NEGATIVE = -1
+    BOTH = 0
+
+    def __init__(self, maxsize=4096):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def propagate(self, pairs):
+        """Returns the propagated signs (see `_propagate_pairs`) for an iterable of packed (prop, val) pairs."""
+        key = frozenset(pairs)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is util.hierarchy_index and \
+               not util.hierarchy_index.is_stale(map(util.value_of, key), entry[1]):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+        index, version = util.hierarchy_index, util.hierarchy_index.version
+        signs = _propagate_pairs(key)
+        with self._lock:
+            self._entries[key] = signs, version, index
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return signs
+
+# Shared by all the aggregate() calls that do not provide their own cache.
+propagation_cache = PropagationCache()
+
+def _pack_descriptions(descriptions, items):
+    return [(belief, util.pack_description(description, items)) for belief, description in descriptions]
+
+def _unpack_statements(statements, items):
+    return {util.unpack_statement(k, items): v for k, v in statements.items()}
+
+def _propagate(descriptions, combination_rules_cls, cache, include_root=True):
+    """Propagates participant's votes to all the generalizing statements (optionally, except for owl.Thing)."""
+    thing = util.entity_id(util.THING)
     # All the propagated statements are stored in a dict, mapping statement to a list of votes.
     statements = {}
     for belief, description in descriptions:
-        this_participant = {}
-        for item, prop, val in description:
-            pos, neg = util.generalize_statement(prop, val)
-            for x in pos:
-                stmt = item, x[0], x[1]
-                if stmt in this_participant:
-                    this_participant[stmt] = combination_rules_cls.multipath_combine(this_participant[stmt], belief)
-                else:
-                    this_participant[stmt] = belief
-            for x in neg:
-                stmt = item, x[0], x[1]
-                if stmt in this_participant:
-                    this_participant[stmt] = combination_rules_cls.multipath_combine(this_participant[stmt], combination_rules_cls.negative(belief))
-                else:
-                    this_participant[stmt] = combination_rules_cls.negative(belief)
-        for stmt, belief in this_participant.items():
-            beliefs = statements.setdefault(stmt, [])
-            beliefs.append(belief)
+        pairs = {}
+        for stmt in description:
+            pairs.setdefault(stmt & ~util.PAIR_MASK, []).append(stmt & util.PAIR_MASK)
+        negative = combination_rules_cls.negative(belief)
+        values = {PropagationCache.POSITIVE: belief,
+                  PropagationCache.NEGATIVE: negative,
+                  PropagationCache.BOTH: combination_rules_cls.multipath_combine(belief, negative)}
+        for item, item_pairs in pairs.items():
+            for pair, sign in cache.propagate(item_pairs).items():
+                if include_root or pair & util.ENTITY_MASK != thing:
+                    beliefs = statements.setdefault(item | pair, [])
+                    beliefs.append(values[sign])
+    return statements
 
+def _select(statements, combination_rules_cls, support_threshold):
+    """Combines the votes and selects the most specific statements with enough support."""
     # Increases the value of the statements where there are more than one evidence.
-    rstatements = {k: functools.reduce(combination_rules_cls.combine, v) for k, v in statements.items()} 
+    rstatements = {k: reduce_beliefs(combination_rules_cls, v) for k, v in statements.items()}
 
     # Selects only those statements that are not "covered" by other and have support at least `support_threshold`.
     statements = {k: v for k, v in rstatements.items() if v >= support_threshold}
@@ -83,12 +220,145 @@ def aggregate(descriptions, combination_rules_cls, support_threshold):
     for stmt in statements_list:
         # Delete all generalizations of the statement
         if stmt in statements:
-            for g_stmt, loss in util.statement_generalizations(stmt):
+            for g_stmt, loss in util.compact_statement_generalizations(stmt):
                 if stmt != g_stmt:
                     if g_stmt in statements:
                         del statements[g_stmt]
     return statements
 
+def aggregate(descriptions, combination_rules_cls, support_threshold, cache=None):
+    """Descriptions aggregation algorithm."""
+    items = util.ItemTable()
+    return _unpack_statements(aggregate_compact(_pack_descriptions(descriptions, items), combination_rules_cls,
+                                                support_threshold, cache), items)
+
+def aggregate_compact(descriptions, combination_rules_cls, support_threshold, cache=None):
+    """Version of `aggregate()` for packed statements (see `util.pack_statement()`)."""
+    if cache is None:
+        cache = propagation_cache
+    return _select(_propagate(descriptions, combination_rules_cls, cache), combination_rules_cls, support_threshold)
+
+def _aggregate_partition(descriptions, combination_rules_cls, support_threshold, cache=None):
+    """Aggregates the packed descriptions of one partition.
+
+    Module-level (and so picklable) to run in process pools; without an explicit `cache`, it
+    uses the `propagation_cache` of the process it runs in.
+    """
+    if cache is None:
+        cache = propagation_cache
+    return _select(_propagate(descriptions, combination_rules_cls, cache, include_root=False),
+                   combination_rules_cls, support_threshold)
+
+def aggregate_partitioned(descriptions, combination_rules_cls, support_threshold, cache=None, executor=None):
+    """
+    Descriptions aggregation algorithm, run separately in each independent sub-hierarchy.
+
+    Statements are routed to the partitions of their values (see `util.hierarchy_partitions()`),
+    which are aggregated and pruned one by one, so the peak memory is bounded by the largest
+    partition. The root-level (owl.Thing) statements are aggregated separately and pruned if they
+    generalize any of the statements selected in the partitions.
+
+    If an `executor` is given, the partitions are aggregated in parallel, each worker with its own
+    `propagation_cache` (`cache` is used only in serial mode). All the partitions are submitted at
+    once, so the memory bound does not hold then. The aggregation is CPU-bound, so only a process
+    pool gives a speedup; its workers must share the ids of packed statements with this process:
+    install a `shared_index.SharedHierarchyIndex` here and attach the workers to it (e.g., with
+    `initializer=shared_index.attach_worker`). Partitions with entities outside the shared index
+    (e.g., classes added after it was built) are aggregated in this process.
+    """
+    items = util.ItemTable()
+    return _unpack_statements(aggregate_partitioned_compact(_pack_descriptions(descriptions, items), combination_rules_cls,
+                                                            support_threshold, cache, executor), items)
+
+def _root_statements(stmt, root_pairs):
+    """Packed root-level (owl.Thing) generalizations of the packed statement.
+
+    `root_pairs` caches the root-level pairs per property id.
+    """
+    prop_id = (stmt & util.PAIR_MASK) >> util.ENTITY_BITS
+    pairs = root_pairs.get(prop_id)
+    if pairs is None:
+        thing = util.entity_id(util.THING)
+        pairs = root_pairs[prop_id] = [util.entity_id(p) << util.ENTITY_BITS | thing 
+                                       for p in util.property_generalizations(util.entity_of(prop_id))]
+    item = stmt & ~util.PAIR_MASK
+    return [item | pair for pair in pairs]
+
+def aggregate_partitioned_compact(descriptions, combination_rules_cls, support_threshold, cache=None, executor=None):
+    """Version of `aggregate_partitioned()` for packed statements (see `util.pack_statement()`)."""
+    if cache is None:
+        cache = propagation_cache
+
+    thing = util.entity_id(util.THING)
+    value_partitions = {}  # value id -> partition
+    root_pairs = {}
+    partitions = {}
+    root = {}
+    for belief, description in descriptions:
+        this_participant = {}
+        root_statements = set()
+        for stmt in description:
+            val = stmt & util.ENTITY_MASK
+            if val != thing:
+                partition = value_partitions.get(val)
+                if partition is None:
+                    partition = value_partitions[val] = util.partition_of(util.entity_of(val))
+                this_participant.setdefault(partition, []).append(stmt)
+            root_statements.update(_root_statements(stmt, root_pairs))
+        for partition, description in this_participant.items():
+            partitions.setdefault(partition, []).append((belief, description))
+        # owl.Thing generalizes every value of the participant, and only positively
+        for stmt in root_statements:
+            root.setdefault(stmt, []).append(belief)
+
+    aggregate_one = functools.partial(_aggregate_partition, combination_rules_cls=combination_rules_cls,
+                                      support_threshold=support_threshold)
+    serial = list(partitions.values())
+    parallel = []
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        if not hasattr(util.hierarchy_index, 'ancestor_ids'):
+            raise ValueError('Process pools need a shared hierarchy index (see shared_index.attach_worker())')
+        # Entities outside the shared index (e.g., classes added after it was built) have
+        # process-local ids, so their partitions are aggregated in this process
+        n = len(util.hierarchy_index)
+        local = []
+        for partition in serial:
+            if all((stmt & util.ENTITY_MASK) < n and (stmt & util.PAIR_MASK) >> util.ENTITY_BITS < n
+                   for _, description in partition for stmt in description):
+                parallel.append(partition)
+            else:
+                local.append(partition)
+        serial = local
+    elif executor is not None:
+        serial, parallel = [], serial
+    statements = {}
+    if parallel:
+        # Submitted before the serial partitions are aggregated, so they run concurrently
+        results = executor.map(aggregate_one, parallel)
+    else:
+        results = ()
+    for selected in map(functools.partial(aggregate_one, cache=cache), serial):
+        statements.update(selected)
+    for selected in results:
+        statements.update(selected)
+
+    root = _select(root, combination_rules_cls, support_threshold)
+    if root:
+        for stmt in statements:
+            for g_stmt in _root_statements(stmt, root_pairs):
+                root.pop(g_stmt, None)
+    statements.update(root)
+    return statements
+
+def _label_object_compact(labeler, item, true_description):
+    """Labels the item with packed statements, also with labelers that have only `label_object()`."""
+    label_object_compact = getattr(labeler, 'label_object_compact', None)
+    if label_object_compact is not None:
+        return label_object_compact(item, true_description)
+    item_key = true_description[0] & ~util.PAIR_MASK
+    description = labeler.label_object(item, [(item, ) + util.unpack_pair(stmt) for stmt in true_description])
+    return [item_key | util.pack_pair(prop, val) for _, prop, val in description]
+
 class AggregateLabeler:
 
     def __init__(self, labelers, combination_cls, support_threshold):
@@ -97,11 +367,16 @@ class AggregateLabeler:
         self.support_threshold = support_threshold
 
     def label_object(self, item, true_description):
-        item_descriptions = [(labeler_belief, labeler.label_object(item, true_description)) \
+        items = util.ItemTable()
+        return util.unpack_description(self.label_object_compact(item, util.pack_description(true_description, items)), items)
+
+    def label_object_compact(self, item, true_description):
+        """Version of `label_object()` for packed statements (see `util.pack_statement()`)."""
+        item_descriptions = [(labeler_belief, _label_object_compact(labeler, item, true_description)) \
                              for labeler, labeler_belief in self.labelers]
-        return [stmt for stmt, belief in aggregate(item_descriptions, 
-                                                   self.combination_cls, 
-                                                   self.support_threshold).items()]
+        return [stmt for stmt, belief in aggregate_compact(item_descriptions, 
+                                                           self.combination_cls, 
+                                                           self.support_threshold).items()]
 
 class VotingAggregateLabeler(AggregateLabeler):
 
@@ -10,8 +10,8 @@ import util
 import labeling_generator
 
 def process_dataset(dataset, labeler):
-    """Labels all items of the dataset with the specified labeler."""
-    return {item: labeler.label_object(item, true_description) for item, true_description in dataset.items()}
+    """Labels all items of the dataset with the specified labeler (packed statements, see `util.pack_statement()`)."""
+    return {item: labeler.label_object_compact(item, true_description) for item, true_description in dataset.items()}
 
 def process_dataset_random_labelers(dataset, labelers, probs, n_labelers, aggregation_constructor):
     """Labels each item by selecting labelers by random and then aggregating by the specified algorithm."""
@@ -20,14 +20,14 @@ def process_dataset_random_labelers(dataset, labelers, probs, n_labelers, aggreg
         selected_labelers = random.choices(labelers, weights=probs, k=n_labelers)
         assert(len(selected_labelers) == n_labelers)
         agg = aggregation_constructor(selected_labelers)
-        labels[item] = agg.label_object(item, true_description)
+        labels[item] = agg.label_object_compact(item, true_description)
     return labels
 
 def evaluate(ground_truth, labels):
     s = 0
     cnt = 0
     for item in sorted(ground_truth.keys()):
-        metric_val = util.metric(ground_truth[item], labels[item])
+        metric_val = util.compact_metric(ground_truth[item], labels[item])
         if metric_val < 10000:
             s += metric_val
             cnt += 1
@@ -78,10 +78,12 @@ low_quality = lambda onto : labeling_generator.Participant(onto, 0.6, 0.6, 0.4)
 
 #####
 # True labels for each dataset
+# The statements are packed for the whole pipeline (labeling, aggregation and metric)
 
-small_gt = labeling_generator.generate_true_statements(small_onto, 500, 'urn:sample_items:', n_secondary=2)
-medium_gt = labeling_generator.generate_true_statements(medium_onto, 500, 'urn:sample_items:', n_secondary=2)
-large_gt = labeling_generator.generate_true_statements(large_onto, 500, 'urn:sample_items:', n_secondary=2)
+items = util.ItemTable()
+small_gt = labeling_generator.generate_true_statements(small_onto, 500, 'urn:sample_items:', n_secondary=2, items=items)
+medium_gt = labeling_generator.generate_true_statements(medium_onto, 500, 'urn:sample_items:', n_secondary=2, items=items)
+large_gt = labeling_generator.generate_true_statements(large_onto, 500, 'urn:sample_items:', n_secondary=2, items=items)
 
 REPS = 10
 
@@ -144,7 +146,7 @@ if True:
     labels = process_dataset(medium_gt, medium_quality(medium_onto))
     errors = []
     for item in sorted(medium_gt.keys()):
-        metric_val = util.metric(medium_gt[item], labels[item])
+        metric_val = util.compact_metric(medium_gt[item], labels[item])
         if metric_val < 10000:
             errors.append(metric_val)
         else:
@@ -158,7 +160,7 @@ if True:
         labels = process_dataset(medium_gt, aggr)
         errors = []
         for item in sorted(medium_gt.keys()):
-            metric_val = util.metric(medium_gt[item], labels[item])
+            metric_val = util.compact_metric(medium_gt[item], labels[item])
             if metric_val < 10000:
                 errors.append(metric_val)
             else:
@@ -24,8 +24,19 @@ class Participant:
         """
         Label the specified item. Returns a list of statements.
         """
+        return [(item, prop, val) for prop, val in self._label_pairs([(prop, val) for _, prop, val in true_description])]
+
+    def label_object_compact(self, item, true_description):
+        """
+        Version of `label_object()` for packed statements (see `util.pack_statement()`).
+        """
+        item_key = true_description[0] & ~util.PAIR_MASK
+        return [item_key | util.pack_pair(prop, val) 
+                for prop, val in self._label_pairs([util.unpack_pair(stmt) for stmt in true_description])]
+
+    def _label_pairs(self, true_pairs):
         description = []
-        for item, prop, val in true_description:
+        for prop, val in true_pairs:
             if random.random() < self.observancy:
                 # Generalize property:
                 # Just selects one of the ancestors
@@ -37,7 +48,7 @@ class Participant:
                 if random.random() < 1 - self.diligence:
                     ancestors = [x for x in val.ancestors() if x != owl.Thing and x != val]
                     val = random.choice(ancestors) if len(ancestors) > 1 else val
-                description.append((item, prop, val))
+                description.append((prop, val))
             else:
                 # overlooked
                 pass
@@ -46,18 +57,21 @@ class Participant:
             if random.random() < self.noise:
                 prop = random.choice([x for x in self.onto.object_properties() if x != owl.ObjectProperty])
                 val = random.choice([x for x in self.onto.classes() if x != owl.Thing])
-                description.append((item, prop, val))
+                description.append((prop, val))
             else:
                 break
         # If no statements were generated, then select one from true randomly:
         if not description:
-            description = [random.choice(true_description)]
+            description = [random.choice(true_pairs)]
         return description
 
-def generate_true_statements(onto, n_items, prefix, n_secondary=2):
+def generate_true_statements(onto, n_items, prefix, n_secondary=2, items=None):
     """
     Generates true description for the specified number of items.
 
+    If an `items` table (`util.ItemTable`) is given, the statements are packed with it
+    (see `util.pack_statement()`).
+
     Note, that this function is ontology-specific. E.g., it 
     relies on the fact that there are several hierarchies in the ontology
     and uses values of different hierarchies for different statements.
@@ -75,7 +89,7 @@ def generate_true_statements(onto, n_items, prefix, n_secondary=2):
             if secondary_topic not in primary_topic.ancestors() and \
                secondary_topic not in primary_topic.descendants():
                 item_description.append((item, onto.hasTopic, secondary_topic))
-        item_descriptions[item] = item_description
+        item_descriptions[item] = util.pack_description(item_description, items) if items is not None else item_description
     return item_descriptions
 
 if __name__ == '__main__':
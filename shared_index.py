@@ -0,0 +1,267 @@
+"""
+Read-only hierarchy index in shared memory, for multiprocess workers.
+
+The owner process builds the index once (`SharedHierarchyIndex.create()`), and the workers
+attach to it by name without copying (`SharedHierarchyIndex.attach()`, or `attach_worker()`
+as a pool initializer). Entities (classes and properties) are identified by their position
+in the IRI-sorted list; ancestors, value losses and negative (disjoint) classes are stored as
+flat arrays with per-entity offsets (empty for properties). The positions are also the entity
+ids of packed statements (see `util.pack_pair()`), so packed statements about the ontology
+mean the same in all the processes using the index.
+
+What is shared is the derived hierarchy data: workers skip the generalization warm-up
+(dominated by disjoints() queries) and do not hold their own copy of the arrays. Each worker
+still loads the ontology with owlready2, which takes most of its memory, and keeps the
+entity-level results (lists of references to the loaded entities) it has looked up.
+"""
+
+import bisect
+import struct
+from array import array
+from multiprocessing import shared_memory
+
+from owlready2 import *
+
+import util
+
+_MAGIC = b'ONTOIDX2'
+_SECTIONS = ('anc_offsets', 'anc_ids', 'anc_losses', 'neg_offsets', 'neg_ids', 'name_offsets', 'names')
+# Magic, number of entities, and (offset, size) of each section
+_HEADER = struct.Struct('<8sq' + 'qq' * len(_SECTIONS))
+_ITEMSIZE = 8
+
+class _Names:
+    """Sequence view of the class IRIs (decoded on access), for bisect."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, cid):
+        return self.index.iri_of(cid)
+
+class SharedHierarchyIndex:
+    """
+    Hierarchy data of an ontology (see `util.HierarchyIndex`) placed in a shared memory block.
+
+    Provides both id-level queries (`ancestor_ids()`, `loss_values()`, `negative_ids()`) and the
+    entity-level interface of `util.HierarchyIndex`, so that it can be installed in place of it.
+    The index is bound to the ontology it was built from (loaded in each process): its classes
+    are resolved in the world of that ontology, and other classes (e.g., of other ontologies
+    loaded in the same process) are served by a regular `util.HierarchyIndex`. The shared part
+    is a snapshot: ontology edits are supported only for the classes outside it.
+    """
+
+    def __init__(self, shm, onto, owner=False):
+        self._shm = shm
+        self.onto = onto
+        self.owner = owner
+        self.fallback = util.HierarchyIndex()
+        header = _HEADER.unpack_from(shm.buf)
+        if header[0] != _MAGIC:
+            raise ValueError('Not a hierarchy index: ' + shm.name)
+        self._n = header[1]
+        self._views = []
+        for i, section in enumerate(_SECTIONS):
+            offset, size = header[2 + 2 * i], header[3 + 2 * i]
+            view = shm.buf[offset:offset + size]
+            self._views.append(view)
+            if section != 'names':
+                view = view.cast('q')
+                self._views.append(view)
+            setattr(self, '_' + section, view)
+        # Entity-level results, built lazily from the shared arrays in each process
+        self._class_ids = {}
+        self._entities = {}
+        self._propagation = {}
+        self._losses = {}
+        self._world = onto.world
+
+    @classmethod
+    def create(cls, onto, name=None):
+        """Builds the index of the ontology classes and properties in a new shared memory block."""
+        classes = set(onto.classes())
+        classes.add(util.THING)
+        data = {}
+        pending = list(classes)
+        while pending:
+            c = pending.pop()
+            pos, neg = util.generalization_propagation(c)
+            losses = util.hierarchy_index.losses(c)
+            data[c] = pos, [losses[x] for x in pos], neg
+            for x in pos + neg:
+                if x not in classes:
+                    classes.add(x)
+                    pending.append(x)
+        entities = set(classes)
+        entities.update([util.OBJECT_PROPERTY, util.DATA_PROPERTY])
+        for prop in onto.properties():
+            entities.add(prop)
+            entities.update(p for p in prop.is_a if hasattr(p, 'iri'))
+        entities = sorted(entities, key=lambda c: c.iri)
+        ids = {c: i for i, c in enumerate(entities)}
+
+        sections = {s: array('q') for s in _SECTIONS if s != 'names'}
+        names = bytearray()
+        for s in ('anc_offsets', 'neg_offsets', 'name_offsets'):
+            sections[s].append(0)
+        for c in entities:
+            pos, losses, neg = data.get(c, ([], [], []))
+            sections['anc_ids'].extend(ids[x] for x in pos)
+            sections['anc_losses'].extend(losses)
+            sections['anc_offsets'].append(len(sections['anc_ids']))
+            sections['neg_ids'].extend(ids[x] for x in neg)
+            sections['neg_offsets'].append(len(sections['neg_ids']))
+            names.extend(c.iri.encode('utf-8'))
+            sections['name_offsets'].append(len(names))
+        sections['names'] = names
+
+        layout = []
+        offset = _HEADER.size
+        for s in _SECTIONS:
+            size = len(sections[s]) * (_ITEMSIZE if s != 'names' else 1)
+            layout.extend([offset, size])
+            offset += size + (-size % _ITEMSIZE)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(offset, 1))
+        _HEADER.pack_into(shm.buf, 0, _MAGIC, len(entities), *layout)
+        for i, s in enumerate(_SECTIONS):
+            start = layout[2 * i]
+            shm.buf[start:start + layout[2 * i + 1]] = bytes(sections[s])
+        return cls(shm, onto, owner=True)
+
+    @classmethod
+    def attach(cls, name, onto):
+        """
+        Attaches to an index created by another process from the same ontology.
+
+        Raises ValueError if some indexed entity is missing in the world of `onto` (e.g., the owner
+        indexed classes added by editing, and the worker loaded the ontology from its file).
+        """
+        # Workers started by multiprocessing share the resource tracker of the owner,
+        # so the block stays alive until the owner unlinks it.
+        shm = shared_memory.SharedMemory(name=name)
+        index = cls(shm, onto)
+        for cid in range(len(index)):
+            if index._world[index.iri_of(cid)] is None:
+                iri = index.iri_of(cid)
+                index.close()
+                raise ValueError('Ontology does not match the hierarchy index: no ' + iri)
+        return index
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def close(self):
+        """Detaches from the index. The owner also frees the shared memory block."""
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+    def __len__(self):
+        return self._n
+
+    # Ids
+
+    def iri_of(self, cid):
+        return bytes(self._names[self._name_offsets[cid]:self._name_offsets[cid + 1]]).decode('utf-8')
+
+    def id_of(self, iri):
+        cid = bisect.bisect_left(_Names(self), iri)
+        if cid == self._n or self.iri_of(cid) != iri:
+            raise KeyError(iri)
+        return cid
+
+    def ancestor_ids(self, cid):
+        return self._anc_ids[self._anc_offsets[cid]:self._anc_offsets[cid + 1]]
+
+    def loss_values(self, cid):
+        """Losses of generalization to each of the `ancestor_ids()`."""
+        return self._anc_losses[self._anc_offsets[cid]:self._anc_offsets[cid + 1]]
+
+    def negative_ids(self, cid):
+        return self._neg_ids[self._neg_offsets[cid]:self._neg_offsets[cid + 1]]
+
+    # Interface of util.HierarchyIndex
+
+    @property
+    def version(self):
+        return self.fallback.version
+
+    def _class_id(self, entity):
+        """Id of the entity, or -1 if it is not in the index."""
+        cid = self._class_ids.get(entity)
+        if cid is None:
+            cid = -1
+            if entity in (util.THING, util.OBJECT_PROPERTY, util.DATA_PROPERTY) or entity.namespace.world is self._world:
+                try:
+                    cid = self.id_of(entity.iri)
+                except KeyError:
+                    pass
+            self._class_ids[entity] = cid
+        return cid
+
+    def entity_id(self, entity):
+        """Id of the entity; entities outside the index get (process-local) ids after the indexed ones."""
+        cid = self._class_id(entity)
+        if cid < 0:
+            return self._n + self.fallback.entity_id(entity)
+        return cid
+
+    def entity_of(self, eid):
+        if eid >= self._n:
+            return self.fallback.entity_of(eid - self._n)
+        return self._entity(eid)
+
+    def _entity(self, cid):
+        entity = self._entities.get(cid)
+        if entity is None:
+            entity = self._world[self.iri_of(cid)]
+            if entity is None:
+                raise KeyError(self.iri_of(cid))
+            self._entities[cid] = entity
+        return entity
+
+    def propagation(self, onto_cls):
+        cid = self._class_id(onto_cls)
+        if cid < 0:
+            return self.fallback.propagation(onto_cls)
+        result = self._propagation.get(cid)
+        if result is None:
+            result = self._propagation[cid] = ([self._entity(x) for x in self.ancestor_ids(cid)],
+                                               [self._entity(x) for x in self.negative_ids(cid)])
+        return result
+
+    def losses(self, obj):
+        cid = self._class_id(obj)
+        if cid < 0:
+            return self.fallback.losses(obj)
+        result = self._losses.get(cid)
+        if result is None:
+            result = self._losses[cid] = {self._entity(x): v for x, v in zip(self.ancestor_ids(cid), self.loss_values(cid))}
+        return result
+
+    def check_editable(self, classes):
+        if any(self._class_id(cls) >= 0 for cls in classes):
+            raise RuntimeError('Shared hierarchy index is read-only')
+
+    def invalidate(self, classes):
+        classes = list(classes)
+        self.check_editable(classes)
+        self.fallback.invalidate(classes)
+
+    def is_stale(self, classes, version):
+        return self.fallback.is_stale(classes, version)
+
+def install(index):
+    """Makes `util` (and so the aggregation) use the index."""
+    util.hierarchy_index = index
+
+def attach_worker(name, onto_path):
+    """Pool initializer: loads the ontology, attaches to its shared index and installs it in the worker."""
+    install(SharedHierarchyIndex.attach(name, get_ontology(onto_path).load()))
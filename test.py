@@ -1,7 +1,15 @@
+import concurrent.futures
+import functools
+import math
+import multiprocessing
+import random
+
 import owlready2
 
 import util
 import aggregation
+import shared_index
+import labeling_generator
 
 def test_generalization():
     # Set-up
@@ -57,8 +65,348 @@ def test_aggregation():
     assert(frozenset(a.keys()) == frozenset([('XXX', small_onto.hasPrimaryTopic, small_onto.H1C1)]) or \
            frozenset(a.keys()) == frozenset([('XXX', small_onto.hasPrimaryTopic, small_onto.S26)]))
 
+def test_propagation_cache():
+    # Set-up
+    small_onto = owlready2.get_ontology('ontologies/ontoagg_small.owl').load()
+
+    cache = aggregation.PropagationCache(maxsize=2)
+    descriptions = [(1, [('XXX', small_onto.hasPrimaryTopic, small_onto.H1C11),
+                         ('XXX', small_onto.hasTopic, small_onto.H2C12)]),
+                    (1, [('XXX', small_onto.hasTopic, small_onto.H2C12),
+                         ('XXX', small_onto.hasPrimaryTopic, small_onto.H1C11)]),
+                    (1, [('YYY', small_onto.hasPrimaryTopic, small_onto.H1C11),
+                         ('YYY', small_onto.hasTopic, small_onto.H2C12)]),
+                   ]
+    a = aggregation.aggregate(descriptions, aggregation.VotingRules, 2, cache=cache)
+    assert(cache.misses == 1 and cache.hits == 2)
+    assert(frozenset(a.keys()) == frozenset([('XXX', small_onto.hasPrimaryTopic, small_onto.H1C11),
+                                             ('XXX', small_onto.hasTopic, small_onto.H2C12)]))
+    assert(a[('XXX', small_onto.hasPrimaryTopic, small_onto.H1C11)] == 2)
+
+    # Negative beliefs reach the disjoint classes
+    a = aggregation.aggregate([(0.9, [('XXX', small_onto.hasPrimaryTopic, small_onto.H1C11)])],
+                              aggregation.SBRules, -1, cache=cache)
+    assert(a[('XXX', small_onto.hasPrimaryTopic, small_onto.H1C12)] == -0.9)
+
+    # Eviction of the least recently used entries
+    for cls in [small_onto.H1C12, small_onto.H1C13]:
+        aggregation.aggregate([(1, [('XXX', small_onto.hasTopic, cls)])], aggregation.VotingRules, 1, cache=cache)
+    assert(len(cache) == 2)
+    assert(cache.stats()['misses'] == 4)
+    assert(cache.hit_rate == 2 / 6)
+
+def test_ontology_editing():
+    # Set-up (a separate world, not to interfere with other tests)
+    onto = owlready2.World().get_ontology('ontologies/ontoagg_small.owl').load()
+
+    index = util.hierarchy_index
+    other = util.generalization_propagation(onto.H2C22)
+    leaf_pos, leaf_neg = util.generalization_propagation(onto.H1C111)
+    assert(onto.H1C12 in leaf_neg)
+    version = index.version
+
+    new_cls = util.add_class(onto, 'H1C14', [onto.H1C1])
+    assert(index.version > version)
+    assert(util.generalization_propagation(onto.H1C111) == (leaf_pos, leaf_neg))
+    util.add_subclass(new_cls, onto.H2C2)
+    pos, neg = util.generalization_propagation(new_cls)
+    assert(frozenset(pos) == frozenset([new_cls, onto.H1C1, onto.S26, onto.H2C2, owlready2.owl.Thing]))
+    assert(frozenset(neg) == frozenset([onto.H1C2, onto.H1C3]))
+
+    version = index.version
+    axiom = util.add_disjoint(onto, [onto.H1C11, new_cls])
+    assert(index.is_stale([onto.H1C111], version))
+    assert(not index.is_stale([onto.H2C22], version))
+    assert(new_cls in util.generalization_propagation(onto.H1C111)[1])
+    assert(util.generalization_propagation(onto.H2C22) is other)  # not recomputed
+
+    util.remove_disjoint(axiom)
+    util.remove_subclass(new_cls, onto.H2C2)
+    assert(new_cls not in util.generalization_propagation(onto.H1C111)[1])
+    assert(onto.H2C2 not in util.generalization_propagation(new_cls)[0])
+
+    util.add_equivalence(new_cls, onto.H2C22)
+    assert(onto.H1C1 in util.generalization_propagation(onto.H2C22)[0])
+    assert(dict(util.statement_generalizations(('XXX', onto.hasTopic, onto.H2C22)))[('XXX', onto.hasTopic, onto.H1C1)] == 1)
+    util.remove_equivalence(new_cls, onto.H2C22)
+    assert(onto.H1C1 not in util.generalization_propagation(onto.H2C22)[0])
+
+    # Cached propagation is recomputed after the edit
+    cache = aggregation.PropagationCache()
+    pair = util.pack_pair(onto.hasTopic, new_cls)
+    assert(util.pack_pair(onto.hasTopic, onto.H2C2) not in cache.propagate([pair]))
+    util.add_subclass(new_cls, onto.H2C2)
+    assert(util.pack_pair(onto.hasTopic, onto.H2C2) in cache.propagate([pair]))
+    assert(cache.misses == 2)
+
+    util.remove_class(new_cls)
+    assert(frozenset(util.generalization_propagation(onto.H1C111)[1]) == frozenset(leaf_neg))
+
+    # A class of a loaded AllDisjoint axiom
+    assert(onto.H1C111 in util.generalization_propagation(onto.H1C112)[1])
+    leaf = onto.H1C111
+    version = index.version
+    util.remove_class(leaf)
+    assert(onto['H1C111'] is None)
+    assert(leaf not in list(onto.H1C11.subclasses()))
+    assert(index.version > version)
+    neg = util.generalization_propagation(onto.H1C112)[1]
+    assert(leaf not in neg and onto.H1C113 in neg)
+
+def test_combination_rules():
+    rng = random.Random(1)
+    for name, rules in aggregation.combination_rules.items():
+        for _ in range(1000):
+            beliefs = [rng.uniform(-0.99, 0.99) for _ in range(rng.randint(1, 8))]
+            if rng.random() < 0.5:
+                # same-sign beliefs
+                beliefs = [abs(v) for v in beliefs] if rng.random() < 0.5 else [-abs(v) for v in beliefs]
+            batched = rules.reduce(beliefs)
+            rng.shuffle(beliefs)
+            scalar = functools.reduce(rules.combine, beliefs)
+            assert math.isclose(batched, scalar, abs_tol=1e-9), (name, beliefs, batched, scalar)
+
+    # Rules without reduce() fall back to pairwise combination
+    class MinRules:
+        combine = staticmethod(min)
+    assert(aggregation.reduce_beliefs(MinRules, [0.5, -0.2, 0.1]) == -0.2)
+
+def test_sb_negative_combination():
+    # Two negative beliefs: v1 + v2 * (1 + v1), symmetric and order-independent
+    assert(math.isclose(aggregation.SBRules.combine(-0.5, -0.2), -0.6))
+    assert(math.isclose(aggregation.SBRules.combine(-0.2, -0.5), -0.6))
+    assert(math.isclose(aggregation.SBRules.combine(aggregation.SBRules.combine(-0.5, -0.2), -0.5), -0.8))
+    assert(math.isclose(aggregation.SBRules.reduce([-0.5, -0.2, -0.5]), -0.8))
+
+def _shared_propagation(iri):
+    pos, neg = util.generalization_propagation(owlready2.default_world[iri])
+    return type(util.hierarchy_index).__name__, sorted(x.iri for x in pos), sorted(x.iri for x in neg)
+
+def _shared_pair(iris):
+    return util.pack_pair(*[owlready2.default_world[iri] for iri in iris])
+
+def test_shared_index():
+    # Set-up
+    small_onto = owlready2.get_ontology('ontologies/ontoagg_small.owl').load()
+    medium_onto = owlready2.get_ontology('ontologies/ontoagg_medium.owl').load()
+
+    index = shared_index.SharedHierarchyIndex.create(small_onto)
+    try:
+        attached = shared_index.SharedHierarchyIndex.attach(index.name, small_onto)
+        assert(len(attached) == len(index))
+        for cls in list(small_onto.classes()) + [owlready2.owl.Thing]:
+            assert(attached.iri_of(attached.id_of(cls.iri)) == cls.iri)
+            assert(attached.propagation(cls) == util.generalization_propagation(cls))
+            assert(attached.losses(cls) == util.hierarchy_index.losses(cls))
+        # Classes of other ontologies are served by a regular index
+        assert(attached.propagation(medium_onto.H1C12) == util.generalization_propagation(medium_onto.H1C12))
+        # Entity ids
+        for entity in [small_onto.hasTopic, small_onto.H1C12, owlready2.owl.Thing, owlready2.owl.ObjectProperty]:
+            assert(attached.entity_id(entity) == index.entity_id(entity) < len(index))
+            assert(attached.entity_of(attached.entity_id(entity)) == entity)
+        assert(attached.entity_id(medium_onto.H1C12) >= len(index))
+        assert(attached.entity_of(attached.entity_id(medium_onto.H1C12)) == medium_onto.H1C12)
+        attached.close()
+
+        with multiprocessing.get_context('fork').Pool(2, shared_index.attach_worker, 
+                                                      (index.name, 'ontologies/ontoagg_small.owl')) as pool:
+            results = pool.map(_shared_propagation, [small_onto.H1C12.iri, small_onto.H2C22.iri])
+        assert(results[0] == ('SharedHierarchyIndex', 
+                              sorted(x.iri for x in [small_onto.H1C12, small_onto.H1C1, small_onto.S26, owlready2.owl.Thing]),
+                              sorted(x.iri for x in [small_onto.H1C13, small_onto.H1C11, small_onto.H1C2, small_onto.H1C3])))
+        assert(results[1][2] == [])
+
+        # Workers started from scratch load the ontology themselves
+        with multiprocessing.get_context('spawn').Pool(1, shared_index.attach_worker, 
+                                                       (index.name, 'ontologies/ontoagg_small.owl')) as pool:
+            assert(pool.map(_shared_propagation, [small_onto.H1C12.iri]) == results[:1])
+            # Packed statements mean the same in all the processes
+            assert(pool.apply(_shared_pair, ([small_onto.hasTopic.iri, small_onto.H1C12.iri], )) == 
+                   index.entity_id(small_onto.hasTopic) << util.ENTITY_BITS | index.entity_id(small_onto.H1C12))
+    finally:
+        index.close()
+
+    # An ontology in a separate world
+    onto = owlready2.World().get_ontology('ontologies/ontoagg_small.owl').load()
+    index = shared_index.SharedHierarchyIndex.create(onto)
+    local_index = util.hierarchy_index
+    shared_index.install(index)
+    try:
+        assert(index.propagation(owlready2.owl.Thing) == ([owlready2.owl.Thing], []))
+        pos, neg = index.propagation(onto.H1C12)
+        assert(frozenset(pos) == frozenset([onto.H1C12, onto.H1C1, onto.S26, owlready2.owl.Thing]))
+
+        # Edits of the shared classes are refused before the ontology is modified
+        try:
+            util.add_subclass(onto.H1C12, onto.H2C2)
+            assert(False)
+        except RuntimeError:
+            pass
+        assert(onto.H2C2 not in onto.H1C12.is_a)
+        # New classes are served by the fallback index
+        new_cls = util.add_class(onto, 'H1C14', [onto.H1C1])
+        assert(onto.H1C1 in util.generalization_propagation(new_cls)[0])
+        util.remove_class(new_cls)
+    finally:
+        shared_index.install(local_index)
+        index.close()
+
+    # Workers must load the ontology the index was built from (including the edits)
+    new_cls = util.add_class(onto, 'H1C14', [onto.H1C1])
+    util.add_class(onto, 'H1C141', [new_cls])
+    index = shared_index.SharedHierarchyIndex.create(onto)
+    try:
+        try:
+            shared_index.SharedHierarchyIndex.attach(index.name, owlready2.World().get_ontology('ontologies/ontoagg_small.owl').load())
+            assert(False)
+        except ValueError:
+            pass
+        attached = shared_index.SharedHierarchyIndex.attach(index.name, onto)
+        assert(attached.entity_of(index.entity_id(new_cls)) == new_cls)
+        attached.close()
+    finally:
+        index.close()
+
+def test_partitioned_aggregation():
+    # Set-up
+    small_onto = owlready2.get_ontology('ontologies/ontoagg_small.owl').load()
+
+    partitions = util.hierarchy_partitions(small_onto)
+    assert(partitions[small_onto.H1C1] == partitions[small_onto.H1C3] == partitions[small_onto.S26])
+    assert(partitions[small_onto.H2C12] == partitions[small_onto.H2C1])
+    assert(partitions[small_onto.H2C1] != partitions[small_onto.H2C2])  # not disjoint, connected only through owl:Thing
+    assert(partitions[small_onto.H1C1] != partitions[small_onto.H2C1])
+    assert(util.partition_of(owlready2.owl.Thing) is None)
+
+    # Built from direct links, without the generalization propagation of every class
+    onto = owlready2.World().get_ontology('ontologies/ontoagg_small.owl').load()
+    partitions = util.hierarchy_partitions(onto)
+    assert(not any(cls in util.hierarchy_index._propagation for cls in onto.classes()))
+    for cls in onto.classes():
+        pos, neg = util.generalization_propagation(cls)
+        assert(all(partitions[x] == partitions[cls] for x in pos + neg if x != owlready2.owl.Thing))
+    assert(len(set(partitions.values())) == len(set(util.hierarchy_partitions(small_onto).values())))
+
+    def canonical(statements):
+        # Equivalent classes are interchangeable in the results
+        return frozenset((item, prop, frozenset(set(val.ancestors()) & set(val.descendants())), belief)
+                         for (item, prop, val), belief in statements.items())
+
+    random.seed(2)
+    ground_truth = labeling_generator.generate_true_statements(small_onto, 20, 'urn:sample_items:')
+    participants = [labeling_generator.Participant(small_onto, 0.75, 0.75, 0.4) for _ in range(5)]
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        for item, true_description in ground_truth.items():
+            labels = [p.label_object(item, true_description) for p in participants]
+            labels.append([(item, small_onto.hasTopic, owlready2.owl.Thing)])
+            for rules, belief, threshold in [(aggregation.VotingRules, 1, 2), 
+                                             (aggregation.VotingRules, 1, 5), 
+                                             (aggregation.SBRules, 0.7, 0.9)]:
+                descriptions = [(belief, description) for description in labels]
+                expected = canonical(aggregation.aggregate(descriptions, rules, threshold))
+                assert(canonical(aggregation.aggregate_partitioned(descriptions, rules, threshold)) == expected)
+                assert(canonical(aggregation.aggregate_partitioned(descriptions, rules, threshold, executor=executor)) == expected)
+
+    # Process pools need the shared index, installed here and in the workers
+    descriptions = [(1, p.label_object(item, true_description)) 
+                    for item, true_description in ground_truth.items() for p in participants]
+    try:
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            aggregation.aggregate_partitioned(descriptions, aggregation.VotingRules, 2, executor=executor)
+        assert(False)
+    except ValueError:
+        pass
+    index = shared_index.SharedHierarchyIndex.create(small_onto)
+    local_index = util.hierarchy_index
+    shared_index.install(index)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('spawn'), 
+                                                    initializer=shared_index.attach_worker, 
+                                                    initargs=(index.name, 'ontologies/ontoagg_small.owl')) as executor:
+            for rules, belief, threshold in [(aggregation.VotingRules, 1, 2), (aggregation.SBRules, 0.7, 0.9)]:
+                descriptions = [(belief, description) for _, description in descriptions]
+                expected = canonical(aggregation.aggregate(descriptions, rules, threshold))
+                assert(canonical(aggregation.aggregate_partitioned(descriptions, rules, threshold, executor=executor)) == expected)
+
+            # Classes added after the index was built are unknown to the workers
+            new_cls = util.add_class(small_onto, 'H1C14', [small_onto.H1C1])
+            try:
+                descriptions = [(1, description + [(description[0][0], small_onto.hasTopic, new_cls)] if description else [])
+                                for _, description in descriptions]
+                expected = canonical(aggregation.aggregate(descriptions, aggregation.VotingRules, 2))
+                assert(canonical(aggregation.aggregate_partitioned(descriptions, aggregation.VotingRules, 2, executor=executor)) == expected)
+            finally:
+                util.remove_class(new_cls)
+    finally:
+        shared_index.install(local_index)
+        index.close()
+
+def test_compact_statements():
+    # Set-up
+    small_onto = owlready2.get_ontology('ontologies/ontoagg_small.owl').load()
+
+    items = util.ItemTable()
+    stmt = ('XXX', small_onto.hasPrimaryTopic, small_onto.H1C11)
+    key = util.pack_statement(stmt, items)
+    assert(util.unpack_statement(key, items) == stmt)
+    assert(key == items.key('XXX') | util.pack_pair(small_onto.hasPrimaryTopic, small_onto.H1C11))
+    assert(util.value_of(key) == small_onto.H1C11)
+    assert(dict(util.compact_statement_generalizations(key)) ==
+           {util.pack_statement(s, items): loss for s, loss in util.statement_generalizations(stmt)})
+    assert(len(items) == 1)
+
+    def tuple_metric(descr1, descr2):
+        total_error = 0
+        for _ in range(2):
+            generalizations = util.description_generalizations(descr2)
+            for stmt in descr1:
+                total_error += min([other_loss + stmt_loss for gen_stmt, stmt_loss in util.statement_generalizations(stmt) 
+                                    for other_loss in [generalizations.get(gen_stmt, 10000)]] + [10000])
+            descr1, descr2 = descr2, descr1
+        return total_error
+
+    random.seed(3)
+    ground_truth = labeling_generator.generate_true_statements(small_onto, 10, 'urn:sample_items:')
+    compact_truth = labeling_generator.generate_true_statements(small_onto, 10, 'urn:sample_items:', items=items)
+    participant = labeling_generator.Participant(small_onto, 0.75, 0.75, 0.4)
+    aggr = aggregation.VotingAggregateLabeler([participant] * 3, 2)
+    for item, true_description in ground_truth.items():
+        assert(util.unpack_description(compact_truth[item], items)[0][0] == item)
+
+        random.seed(item)
+        labels = participant.label_object(item, true_description)
+        random.seed(item)
+        assert(util.unpack_description(participant.label_object_compact(item, util.pack_description(true_description, items)), 
+                                       items) == labels)
+        assert(util.metric(true_description, labels) == tuple_metric(true_description, labels))
+
+        random.seed(item)
+        labels = aggr.label_object(item, true_description)
+        random.seed(item)
+        assert(util.unpack_description(aggr.label_object_compact(item, util.pack_description(true_description, items)), 
+                                       items) == labels)
+
+    # Labelers with only label_object()
+    class TupleLabeler:
+        def label_object(self, item, true_description):
+            return list(true_description)
+    aggr = aggregation.VotingAggregateLabeler([TupleLabeler(), TupleLabeler()], 2)
+    def canonical(description):
+        # Equivalent classes are interchangeable in the results
+        return frozenset((item, prop, frozenset(set(val.ancestors()) & set(val.descendants())))
+                         for item, prop, val in description)
+    for item, true_description in ground_truth.items():
+        assert(canonical(aggr.label_object(item, true_description)) == canonical(true_description))
+
 
 if __name__ == '__main__':
 
     test_generalization()
-    test_aggregation()
\ No newline at end of file
+    test_aggregation()
+    test_propagation_cache()
+    test_ontology_editing()
+    test_combination_rules()
+    test_sb_negative_combination()
+    test_shared_index()
+    test_partitioned_aggregation()
+    test_compact_statements()
\ No newline at end of file
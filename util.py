@@ -1,7 +1,14 @@
-from functools import lru_cache
+import threading
+import types
 
 from owlready2 import *
 
+# Namespace attributes of owlready2 are resolved on each access, so the entities
+# compared with in the hot paths are looked up once.
+THING = owl.Thing
+OBJECT_PROPERTY = owl.ObjectProperty
+DATA_PROPERTY = owl.DatatypeProperty  # owl.DataProperty is None
+
 def print_description(onto):
     print('Base IRI:', onto.base_iri)
     print('Imported ontologies:', list(onto.imported_ontologies))
@@ -10,42 +17,307 @@ def print_description(onto):
     print('Number of object properties:', len(list(onto.object_properties())))
     print('Number of data properties:', len(list(onto.data_properties())))
 
-# Performance analysis has shown that this function is the main
-# time consumer (especially, its call to disjoint()). Provided that
-# during experiments we do not modify the ontology, generalization
-# results can be cached.
-# NOTE: Will break if we try to modify the ontology.
-# NOTE ALSO: May cause a severe memory sink with large ontologies
-@lru_cache(maxsize=None)
-def generalization_propagation(onto_cls):
-    """
-    Lists all the classes that are ancestors of the given class, equivalent to ancestors, and disjoint with them.
-    """
+def _generalization_propagation(onto_cls):
     ancestors = list(onto_cls.ancestors())
     negative = []
     for cls in ancestors:
         # Disjoints query for owl:Thing raises an error (which is reasonable)
-        if cls == owl.Thing:
+        if cls == THING:
             continue
         for d in cls.disjoints():
             negative.extend([x for x in d.entities if x != cls])
     return ancestors, negative
 
+class HierarchyIndex:
+    """
+    Derived hierarchy data: generalization propagation (ancestors and disjoint classes) and value losses.
+
+    Performance analysis has shown that generalization propagation is the main time consumer
+    (especially, its call to disjoint()), so the results are cached per class. When the ontology
+    is edited (see `add_class()`, `add_subclass()`, `add_equivalence()`, `add_disjoint()` and
+    their removal counterparts), only the classes whose ancestors or disjoints might have changed
+    are invalidated. `version` is incremented on each edit, and `is_stale()` tells whether the data
+    of some classes has changed since a given version. The index also assigns the entity ids of
+    packed statements (see `pack_pair()`), on first use.
+
+    NOTE: May cause a severe memory sink with large ontologies.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._propagation = {}
+        self._losses = {}
+        self._stamps = {}  # class -> version at which its data was last invalidated
+        self._entities = []
+        self._entity_ids = {}
+        self._lock = threading.Lock()
+
+    def entity_id(self, entity):
+        eid = self._entity_ids.get(entity)
+        if eid is None:
+            with self._lock:
+                eid = self._entity_ids.get(entity)
+                if eid is None:
+                    eid = len(self._entities)
+                    self._entities.append(entity)
+                    self._entity_ids[entity] = eid
+        return eid
+
+    def entity_of(self, eid):
+        return self._entities[eid]
+
+    def propagation(self, onto_cls):
+        """See `generalization_propagation()`."""
+        result = self._propagation.get(onto_cls)
+        if result is None:
+            result = self._propagation[onto_cls] = _generalization_propagation(onto_cls)
+        return result
+
+    def losses(self, obj):
+        """See `analyse_object()`."""
+        result = self._losses.get(obj)
+        if result is None:
+            result = self._losses[obj] = analyse_object(obj)
+        return result
+
+    def check_editable(self, classes):
+        """Raises RuntimeError if the data of the classes cannot be invalidated."""
+        pass
+
+    def invalidate(self, classes):
+        """Drops the data of the given classes (not their descendants, see `subtree()`)."""
+        self.version += 1
+        for cls in classes:
+            self._propagation.pop(cls, None)
+            self._losses.pop(cls, None)
+            self._stamps[cls] = self.version
+
+    def is_stale(self, classes, version):
+        """Checks if the data of any of the classes was invalidated after the given version."""
+        if version == self.version:
+            return False
+        return any(self._stamps.get(cls, 0) > version for cls in classes)
+
+hierarchy_index = HierarchyIndex()
+
+def generalization_propagation(onto_cls):
+    """
+    Lists all the classes that are ancestors of the given class, equivalent to ancestors, and disjoint with them.
+    """
+    return hierarchy_index.propagation(onto_cls)
+
+# Ontology editing
+# The following functions modify the ontology and invalidate the affected part of `hierarchy_index`.
+# An edit is refused (before anything is modified) if the index cannot update the affected classes.
+# The data of a class depends on its ancestors and on the classes disjoint with them, so an edit
+# affects the subtrees (descendants, including equivalent classes) of the edited classes.
+def subtree(classes):
+    """Lists all the descendants of the classes (including the classes and their equivalents)."""
+    result = set()
+    for cls in classes:
+        if cls not in result:
+            result.update(cls.descendants())
+    return result
+
+def add_class(onto, name, parents=(owl.Thing, )):
+    existing = onto[name]
+    affected = subtree([existing]) if existing is not None else set()
+    hierarchy_index.check_editable(affected)
+    with onto:
+        cls = types.new_class(name, tuple(parents))
+    hierarchy_index.invalidate(affected | {cls})
+    return cls
+
+def remove_class(cls):
+    # destroy_entity() fails on classes of loaded AllDisjoint axioms, so the class is removed
+    # from them first (the remaining classes stay pairwise disjoint)
+    axioms = list(cls.disjoints())
+    affected = subtree([cls] + [x for d in axioms for x in d.entities if x != cls])
+    hierarchy_index.check_editable(affected)
+    try:
+        for axiom in axioms:
+            rest = [x for x in axiom.entities if x != cls]
+            onto = axiom.ontology
+            axiom.destroy()
+            if len(rest) > 1:
+                with onto:
+                    AllDisjoint(rest)
+        destroy_entity(cls)
+    finally:
+        hierarchy_index.invalidate(affected)
+
+def add_subclass(cls, parent):
+    affected = subtree([cls])
+    hierarchy_index.check_editable(affected)
+    cls.is_a.append(parent)
+    hierarchy_index.invalidate(affected)
+
+def remove_subclass(cls, parent):
+    affected = subtree([cls])
+    hierarchy_index.check_editable(affected)
+    cls.is_a.remove(parent)
+    hierarchy_index.invalidate(affected)
+
+def add_equivalence(cls1, cls2):
+    affected = subtree([cls1, cls2])
+    hierarchy_index.check_editable(affected)
+    cls1.equivalent_to.append(cls2)
+    hierarchy_index.invalidate(affected)
+
+def remove_equivalence(cls1, cls2):
+    affected = subtree([cls1, cls2])
+    hierarchy_index.check_editable(affected)
+    if cls2 in cls1.equivalent_to:
+        cls1.equivalent_to.remove(cls2)
+    else:
+        cls2.equivalent_to.remove(cls1)
+    hierarchy_index.invalidate(affected)
+
+def add_disjoint(onto, classes):
+    """Declares the classes pairwise disjoint. Returns the axiom (to be used with `remove_disjoint()`)."""
+    affected = subtree(classes)
+    hierarchy_index.check_editable(affected)
+    with onto:
+        axiom = AllDisjoint(list(classes))
+    hierarchy_index.invalidate(affected)
+    return axiom
+
+def remove_disjoint(axiom):
+    affected = subtree(axiom.entities)
+    hierarchy_index.check_editable(affected)
+    axiom.destroy()
+    hierarchy_index.invalidate(affected)
+
+def property_generalizations(prop):
+    """
+    Lists the property and the properties it directly specializes.
+    """
+    return [p for p in [prop] + prop.is_a if p != OBJECT_PROPERTY and p != DATA_PROPERTY]
+
 def generalize_statement(prop, val):
     """
     Lists all the generalized versions of some statement (about an implicit object).
     """
     positive_statements = []
     negative_statements = []
-    for p in [prop] + prop.is_a:
-        if p != owl.ObjectProperty and p != owl.DataProperty:
-            pos_class, neg_class = generalization_propagation(val)
-            for cls in pos_class:
-                positive_statements.append((p, cls))
-            for cls in neg_class:
-                negative_statements.append((p, cls))
+    for p in property_generalizations(prop):
+        pos_class, neg_class = generalization_propagation(val)
+        for cls in pos_class:
+            positive_statements.append((p, cls))
+        for cls in neg_class:
+            negative_statements.append((p, cls))
     return positive_statements, negative_statements
 
+# Partitions
+# Statements about classes of independent sub-hierarchies generalize to each other only at owl.Thing,
+# so they can be aggregated separately.
+_partitions = {}  # ontology -> (index, index version, partitions)
+
+def hierarchy_partitions(onto):
+    """
+    Splits the classes of the ontology into independent sub-hierarchies (connected only through owl.Thing).
+
+    Two classes are in the same partition if one generalizes or is disjoint with the other (see
+    `generalization_propagation()`). Returns a dict mapping each class to its partition (a representative
+    class). The partitions are detected once and recomputed only if the ontology was edited.
+    """
+    index, version, partitions = _partitions.get(onto, (None, None, None))
+    if index is hierarchy_index and version == hierarchy_index.version:
+        return partitions
+    parent = {}
+    def find(x):
+        root = parent.setdefault(x, x)
+        while parent[root] != root:
+            root = parent[root]
+        while x != root:
+            parent[x], x = root, parent[x]
+        return root
+    def union(x, y):
+        if x != THING and y != THING:
+            parent[find(x)] = find(y)
+    # The components of direct subclass, equivalence and disjointness links are the same as of
+    # the generalization propagation, and do not need its (slow) computation for every class
+    for cls in onto.classes():
+        find(cls)
+        for x in cls.is_a + cls.equivalent_to:
+            if isinstance(x, ThingClass):
+                union(x, cls)
+    for axiom in onto.disjoint_classes():
+        classes = [x for x in axiom.entities if isinstance(x, ThingClass)]
+        for x in classes[1:]:
+            union(x, classes[0])
+    partitions = {cls: find(cls) for cls in parent}
+    _partitions[onto] = hierarchy_index, hierarchy_index.version, partitions
+    return partitions
+
+def partition_of(cls):
+    """Returns the partition of the class (see `hierarchy_partitions()`), or None for owl.Thing."""
+    if cls == THING:
+        return None
+    return hierarchy_partitions(cls.namespace.ontology)[cls]
+
+# Compact statements
+# Inside the pipeline (participant simulation, aggregation and metric) a statement (item, prop, val)
+# is packed into a single int, made of the ids of the item, the property and the value. Entity ids
+# are assigned by `hierarchy_index` (a shared index gives the same ids in all the processes), and
+# item ids by an `ItemTable`, scoped to a call or a dataset. The lower bits (the packed (prop, val)
+# pair) do not depend on the item, so a statement is the item part combined with a pair by `|`.
+ENTITY_BITS = 32
+ENTITY_MASK = (1 << ENTITY_BITS) - 1
+PAIR_MASK = (1 << 2 * ENTITY_BITS) - 1
+
+class ItemTable:
+    """
+    Ids of the items of packed statements.
+    """
+
+    def __init__(self):
+        self._items = []
+        self._item_ids = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def key(self, item):
+        """Packed item part of the statements about the item."""
+        i = self._item_ids.get(item)
+        if i is None:
+            i = self._item_ids[item] = len(self._items)
+            self._items.append(item)
+        return i << 2 * ENTITY_BITS
+
+    def item_of(self, stmt):
+        return self._items[stmt >> 2 * ENTITY_BITS]
+
+def entity_id(entity):
+    return hierarchy_index.entity_id(entity)
+
+def entity_of(eid):
+    return hierarchy_index.entity_of(eid)
+
+def pack_pair(prop, val):
+    return hierarchy_index.entity_id(prop) << ENTITY_BITS | hierarchy_index.entity_id(val)
+
+def unpack_pair(pair):
+    return hierarchy_index.entity_of((pair & PAIR_MASK) >> ENTITY_BITS), hierarchy_index.entity_of(pair & ENTITY_MASK)
+
+def value_of(stmt):
+    """Value of a packed statement (or pair)."""
+    return hierarchy_index.entity_of(stmt & ENTITY_MASK)
+
+def pack_statement(stmt, items):
+    item, prop, val = stmt
+    return items.key(item) | pack_pair(prop, val)
+
+def unpack_statement(stmt, items):
+    return (items.item_of(stmt), ) + unpack_pair(stmt)
+
+def pack_description(descr, items):
+    return [pack_statement(stmt, items) for stmt in descr]
+
+def unpack_description(descr, items):
+    return [unpack_statement(stmt, items) for stmt in descr]
+
 # Metric
 # Metric is based on two operations:
 # - get all the possible generalizations for each statement of A (associated with minimum number of transformations
@@ -59,7 +331,7 @@ def generalize_statement(prop, val):
 def analyse_property(prop):
     q = [(prop, len(prop.is_a))]
     for p in prop.is_a:
-        v = len(p.is_a) if p != owl.ObjectProperty else 0
+        v = len(p.is_a) if p != OBJECT_PROPERTY else 0
         q.append((p, v))
     q = sorted(q, key = lambda x: x[1])
     mx = max(x[1] for x in q)
@@ -68,7 +340,7 @@ def analyse_property(prop):
 def analyse_object(obj):
     q = []
     for o in obj.ancestors():
-        v = len(o.ancestors()) if o != owl.Thing else 0
+        v = len(o.ancestors()) if o != THING else 0
         q.append((o, v))
     q = sorted(q, key = lambda x: x[1])
     vs = {}
@@ -83,11 +355,29 @@ def statement_generalizations(stmt):
     """Builds all generalizations of the statement and values them."""
     obj = stmt[0]
     prop_generalizations = analyse_property(stmt[1])
-    value_generalizations = analyse_object(stmt[2])
+    value_generalizations = hierarchy_index.losses(stmt[2])
     for prop, prop_loss in prop_generalizations.items():
         for val, val_loss in value_generalizations.items():
             yield (obj, prop, val), prop_loss + val_loss
 
+_pair_generalizations = {}  # pair -> (hierarchy_index, its version, generalizations)
+
+def compact_statement_generalizations(stmt):
+    """Packed version of `statement_generalizations()`."""
+    pair = stmt & PAIR_MASK
+    index, version, generalizations = _pair_generalizations.get(pair, (None, None, None))
+    if index is not hierarchy_index or hierarchy_index.is_stale([value_of(pair)], version):
+        index, version = hierarchy_index, hierarchy_index.version
+        prop, val = unpack_pair(pair)
+        value_generalizations = [(entity_id(v), v_loss) for v, v_loss in hierarchy_index.losses(val).items()]
+        generalizations = [(entity_id(p) << ENTITY_BITS | v, p_loss + v_loss)
+                           for p, p_loss in analyse_property(prop).items()
+                           for v, v_loss in value_generalizations]
+        _pair_generalizations[pair] = index, version, generalizations
+    item = stmt & ~PAIR_MASK
+    for g_pair, loss in generalizations:
+        yield item | g_pair, loss
+
 def description_generalizations(descr):
     """Builds a union of generalization for a description (multiple statements)."""
     generalizations = {}
@@ -97,6 +387,15 @@ def description_generalizations(descr):
             generalizations[(_, prop, val)] = min(stmt_loss, current_stmt_loss)
     return generalizations            
 
+def compact_description_generalizations(descr):
+    """Packed version of `description_generalizations()`."""
+    generalizations = {}
+    for stmt in descr:
+        for g_stmt, stmt_loss in compact_statement_generalizations(stmt):
+            current_stmt_loss = generalizations.get(g_stmt, stmt_loss)
+            generalizations[g_stmt] = min(stmt_loss, current_stmt_loss)
+    return generalizations
+
 def metric(descr1, descr2):
     """
     Defines how close are two descriptions. 
@@ -104,6 +403,11 @@ def metric(descr1, descr2):
     Each description is an iterable of some statements (triples). All objects (first component
     of each triple) are considered to be the same (Not tested).
     """
+    items = ItemTable()
+    return compact_metric(pack_description(descr1, items), pack_description(descr2, items))
+
+def compact_metric(descr1, descr2):
+    """Packed version of `metric()`."""
 
     # The algorithm is the following.
     # 1. Build all possible generalizing statements for each of the descr1 statements.
@@ -113,10 +417,10 @@ def metric(descr1, descr2):
     total_error = 0
     count = 0
     for _ in range(2):
-        generalizations = description_generalizations(descr2)
+        generalizations = compact_description_generalizations(descr2)
         for stmt in descr1:
             min_loss = 10000
-            for gen_stmt, stmt_loss in statement_generalizations(stmt):
+            for gen_stmt, stmt_loss in compact_statement_generalizations(stmt):
                 other_loss = generalizations.get(gen_stmt, 10000)
                 if other_loss + stmt_loss < min_loss:
                     min_loss = other_loss + stmt_loss